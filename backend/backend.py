@@ -1,8 +1,9 @@
 from dotenv import load_dotenv
 import numpy as np
 import pandas as pd
-from fastapi import FastAPI, File, UploadFile, HTTPException, Body, Depends, status
+from fastapi import FastAPI, File, UploadFile, HTTPException, Body, Depends, status, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from tensorflow.keras.preprocessing.image import img_to_array
 from PIL import Image
@@ -16,6 +17,11 @@ from psycopg2.extras import RealDictCursor
 import uuid
 import tensorflow as tf
 import jwt
+from ensemble import (AUGMENTATIONS, ENSEMBLE_MAX_MODELS, augmented_views, previous_versions,
+                      scale_probabilities, temperature_key)
+import json
+import threading
+import time
 from datetime import datetime, timedelta
 import bcrypt
 from functools import wraps
@@ -43,7 +49,98 @@ security = HTTPBearer()
 def get_db_connection():
     return psycopg2.connect(DATABASE_URL)
 
-model = tf.keras.models.load_model('../dummy_model.h5')
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(BASE_DIR, 'dummy_model.h5')
+MODELS_DIR = os.path.join(BASE_DIR, 'models')
+MODEL_REGISTRY_PATH = os.path.join(MODELS_DIR, 'registry.json')
+SHADOW_LOG_PATH = os.path.join(MODELS_DIR, 'shadow_log.jsonl')
+
+CLASS_LABELS = ['Choroidal Neovascularization', 'Diabetic Macular Edema', 'Drusen', 'Normal']
+
+# Shadow scoring: the latest rejected retraining candidate scores live traffic
+# in the background; its predictions are logged, never returned to the client.
+# The log is report-only and does not feed into promotion decisions
+SHADOW_ENABLED = os.environ.get('SHADOW_ENABLED', 'false').lower() == 'true'
+REGISTRY_POLL_SECONDS = float(os.environ.get('REGISTRY_POLL_SECONDS', '30'))
+
+model = tf.keras.models.load_model(MODEL_PATH)
+model_version = None
+registry = None
+shadow_model = None
+shadow_version = None
+registry_mtime = None
+registry_lock = threading.Lock()
+ensemble_models = {}
+
+def load_registry():
+    if not os.path.exists(MODEL_REGISTRY_PATH):
+        return None
+    with open(MODEL_REGISTRY_PATH) as f:
+        return json.load(f)
+
+def load_model_safely(path, description):
+    try:
+        return tf.keras.models.load_model(path)
+    except Exception as e:
+        print(f"Failed to load {description} from {path}: {str(e)}")
+        return None
+
+def refresh_models():
+    """
+    Reload the production and shadow models when the retraining registry
+    changes, so promotions take effect without restarting the API.
+    New models are fully loaded before they are swapped in. If a load fails
+    the current production model keeps serving and shadow scoring is disabled.
+    """
+    global model, model_version, registry, shadow_model, shadow_version, registry_mtime
+
+    if not os.path.exists(MODEL_REGISTRY_PATH):
+        return
+    mtime = os.path.getmtime(MODEL_REGISTRY_PATH)
+    if mtime == registry_mtime:
+        return
+
+    with registry_lock:
+        if mtime == registry_mtime:
+            return
+        # Recorded up front so a broken registry or model file is not retried on every poll
+        registry_mtime = mtime
+
+        try:
+            new_registry = load_registry()
+        except (OSError, ValueError) as e:
+            print(f"Failed to read model registry: {str(e)}")
+            return
+        registry = new_registry
+
+        production_version = registry.get('production')
+        if production_version != model_version:
+            # Promotion replaces MODEL_PATH before the registry is written
+            loaded = load_model_safely(MODEL_PATH, f"production model {production_version}")
+            if loaded is not None:
+                model, model_version = loaded, production_version
+
+        version = registry.get('shadow') if SHADOW_ENABLED else None
+        if version != shadow_version:
+            entry = next((v for v in registry['versions'] if v['version'] == version), None)
+            loaded = load_model_safely(entry['path'], f"shadow model {version}") if entry else None
+            shadow_model = loaded
+            shadow_version = version if loaded is not None else None
+
+def watch_registry():
+    while True:
+        time.sleep(REGISTRY_POLL_SECONDS)
+        try:
+            refresh_models()
+        except Exception as e:
+            print(f"Model registry refresh failed: {str(e)}")
+
+refresh_models()
+
+@app.on_event("startup")
+def start_registry_watcher():
+    # Reload in the background so no /predict request waits on load_model
+    threading.Thread(target=watch_registry, daemon=True).start()
 
 # helper functions
 def preprocess_image(image):
@@ -52,6 +149,111 @@ def preprocess_image(image):
     img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
     return img_array
 
+# Test-time augmentation and ensemble mode (opt-in per /predict request)
+ensemble_runners = {}
+
+def evict_ensemble_caches(keep_versions):
+    """Drop cached models and runners for versions no longer eligible for an ensemble."""
+    for version in list(ensemble_models):
+        if version not in keep_versions:
+            ensemble_models.pop(version, None)
+    for key in list(ensemble_runners):
+        if key[0] != (model_version or 'baseline') or not set(key[1:]) <= keep_versions:
+            ensemble_runners.pop(key, None)
+
+def get_ensemble_members(size: int):
+    """
+    Return up to `size` (version, model) pairs. The served model is always
+    first, followed by previously promoted versions from the registry,
+    newest first. Only the newest ENSEMBLE_MAX_MODELS versions stay cached.
+    """
+    production_version = model_version
+    members = [(production_version or 'baseline', model)]
+
+    eligible = previous_versions(registry, production_version, ENSEMBLE_MAX_MODELS - 1)
+    evict_ensemble_caches({entry['version'] for entry in eligible})
+
+    for entry in eligible[:size - 1]:
+        version = entry['version']
+        cached = ensemble_models.get(version)
+        if cached is None:
+            loaded = load_model_safely(entry['path'], f"ensemble model {version}")
+            if loaded is None:
+                continue
+            cached = ensemble_models.setdefault(version, loaded)
+        members.append((version, cached))
+    return members
+
+def get_ensemble_runner(members):
+    """
+    Build (once per member set) a traced function that feeds the same stacked
+    batch through every member in a single graph call.
+    """
+    key = tuple(version for version, _ in members)
+    if key not in ensemble_runners:
+        member_models = [m for _, m in members]
+
+        @tf.function(reduce_retracing=True)
+        def run(batch):
+            return tf.stack([m(batch, training=False) for m in member_models])
+
+        ensemble_runners[key] = run
+    return ensemble_runners[key]
+
+def robust_predict(image, augmentations: int, ensemble: int):
+    """
+    Predict with test-time augmentation and/or a model ensemble.
+    All augmented views are stacked into one batch and run through every
+    member together. The averaged probabilities are scaled with the
+    temperature retraining fitted on the held-out set for this exact
+    (augmentations, models) configuration; until one exists they are
+    returned unscaled and reported as uncalibrated.
+    Also returns the served model's class for the unaugmented image.
+    """
+    batch = augmented_views(image, augmentations)
+    members = get_ensemble_members(ensemble)
+    # Shape: (models, augmentations, classes)
+    predictions = get_ensemble_runner(members)(tf.constant(batch)).numpy()
+
+    temperatures = (registry or {}).get('temperatures', {})
+    temperature = temperatures.get(temperature_key(augmentations, len(members)))
+    probabilities = scale_probabilities(predictions.mean(axis=(0, 1)), temperature or 1.0)
+
+    predicted_class = int(np.argmax(probabilities))
+    votes = np.argmax(predictions, axis=-1)
+    # members[0] is the served model and AUGMENTATIONS[0] is the original image
+    production_class = CLASS_LABELS[int(votes[0][0])]
+    return probabilities, production_class, {
+        'augmentations': augmentations,
+        'models': [version for version, _ in members],
+        'temperature': temperature or 1.0,
+        'calibrated': temperature is not None,
+        'agreement': float(np.mean(votes == predicted_class))
+    }
+
+def shadow_predict(shadow_model, shadow_version, img_array, production_class: str, filename: str):
+    """Score a request with the shadow model and log it next to production."""
+    try:
+        began = time.perf_counter()
+        prediction = shadow_model.predict(img_array, verbose=0)
+        latency_ms = (time.perf_counter() - began) * 1000
+        shadow_class = CLASS_LABELS[int(np.argmax(prediction, axis=1)[0])]
+
+        record = {
+            'shadow_version': shadow_version,
+            'filename': filename,
+            'production_class': production_class,
+            'shadow_class': shadow_class,
+            'shadow_probability': float(np.max(prediction)),
+            'latency_ms': latency_ms,
+            'timestamp': datetime.now().isoformat()
+        }
+        os.makedirs(os.path.dirname(SHADOW_LOG_PATH) or '.', exist_ok=True)
+        with open(SHADOW_LOG_PATH, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except Exception as e:
+        print(f"Shadow prediction failed for {filename}: {str(e)}")
+
 # Authentication helper functions
 def hash_password(password: str) -> str:
     """Hash a password for storing."""
@@ -400,7 +602,15 @@ async def get_scans_by_patient(patient_id: str):
 
 
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def predict(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                  tta: int = 1, ensemble: int = 1):
+    # tta: number of augmented views (1 = original image only)
+    # ensemble: number of model versions (1 = production model only)
+    if not 1 <= tta <= len(AUGMENTATIONS):
+        raise HTTPException(status_code=400, detail=f"tta must be between 1 and {len(AUGMENTATIONS)}")
+    if not 1 <= ensemble <= ENSEMBLE_MAX_MODELS:
+        raise HTTPException(status_code=400, detail=f"ensemble must be between 1 and {ENSEMBLE_MAX_MODELS}")
+
     try:
         contents = await file.read()
         image = Image.open(io.BytesIO(contents))
@@ -418,22 +628,37 @@ async def predict(file: UploadFile = File(...)):
         image.save(file_path)
         
         img_array = preprocess_image(image)
-        prediction = model.predict(img_array)
+        inference = None
+        if tta == 1 and ensemble == 1:
+            prediction = model.predict(img_array)
+            production_class = None
+        else:
+            probabilities, production_class, inference = await run_in_threadpool(
+                robust_predict, image, tta, ensemble
+            )
+            prediction = probabilities[np.newaxis, :]
         predicted_class = np.argmax(prediction, axis=1)[0]
         predicted_probability = prediction[0][predicted_class]
         accuracy = round(float(predicted_probability) * 100, 2)
 
-        class_labels = ['Choroidal Neovascularization', 'Diabetic Macular Edema', 'Drusen', 'Normal']
-        predicted_class = class_labels[predicted_class]
+        predicted_class = CLASS_LABELS[predicted_class]
+        production_class = production_class or predicted_class
 
         print(predicted_class)
 
-        return {
+        if shadow_model is not None:
+            # Shadow is compared against the single-model production prediction
+            background_tasks.add_task(shadow_predict, shadow_model, shadow_version, img_array, production_class, filename)
+
+        result = {
             'predicted_class': str(predicted_class),
             'predicted_probability': accuracy / 100,
             'image_url': f"uploads/{filename}",
             'upload_date': datetime.now().isoformat()
         }
+        if inference is not None:
+            result['inference'] = inference
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,63 @@
+"""
+Test-time augmentation and ensemble helpers shared by the API and the
+retraining task, so calibration is fitted on the same aggregate that is served.
+"""
+import os
+import numpy as np
+from PIL import Image
+from tensorflow.keras.preprocessing.image import img_to_array
+
+IMAGE_SIZE = (299, 299)
+
+# Vertical flips are left out since retinal layers have a fixed orientation
+TTA_CROP_RATIO = 0.9
+AUGMENTATIONS = ['original', 'flip', 'crop_center', 'crop_top_left', 'crop_bottom_right']
+ENSEMBLE_MAX_MODELS = int(os.environ.get('ENSEMBLE_MAX_MODELS', '3'))
+
+def augment_image(image, augmentation: str):
+    """Apply a single test-time augmentation to a PIL image."""
+    if augmentation == 'original':
+        return image
+    if augmentation == 'flip':
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+
+    width, height = image.size
+    crop_width, crop_height = int(width * TTA_CROP_RATIO), int(height * TTA_CROP_RATIO)
+    if augmentation == 'crop_center':
+        left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    elif augmentation == 'crop_top_left':
+        left, top = 0, 0
+    elif augmentation == 'crop_bottom_right':
+        left, top = width - crop_width, height - crop_height
+    else:
+        raise ValueError(f"Unknown augmentation: {augmentation}")
+    return image.crop((left, top, left + crop_width, top + crop_height))
+
+def augmented_views(image, count: int):
+    """Return the first `count` augmented views of a PIL image as one stacked batch."""
+    return np.stack([
+        img_to_array(augment_image(image, a).resize(IMAGE_SIZE)) for a in AUGMENTATIONS[:count]
+    ])
+
+def previous_versions(registry, production_version, count: int):
+    """
+    Return up to `count` registry entries for previously promoted versions,
+    newest first, excluding the production version.
+    """
+    if not registry or count <= 0:
+        return []
+    entries = [
+        v for v in reversed(registry['versions'])
+        if v['promoted'] and v['version'] != production_version and os.path.exists(v['path'])
+    ]
+    return entries[:count]
+
+def temperature_key(augmentations: int, models: int):
+    return f"{augmentations},{models}"
+
+def scale_probabilities(probabilities, temperature: float):
+    """Temperature-scale probabilities along the last axis."""
+    logits = np.log(np.clip(probabilities, 1e-7, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=-1, keepdims=True)
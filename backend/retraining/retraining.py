@@ -1,17 +1,51 @@
 from celery import Celery
 from celery.schedules import crontab
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import tensorflow as tf
+import json
 import os
+import shutil
+import sys
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import numpy as np
 from PIL import Image
-import os
 from tensorflow.keras.preprocessing.image import img_to_array
 
+# Same paths as backend.py, which serves MODEL_PATH and watches REGISTRY_PATH
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MODEL_PATH = os.path.join(BASE_DIR, 'dummy_model.h5')
 UPLOADS_PATH = os.path.join(BASE_DIR, 'uploads')
+MODELS_DIR = os.path.join(BASE_DIR, 'models')
+REGISTRY_PATH = os.path.join(MODELS_DIR, 'registry.json')
+SHADOW_LOG_PATH = os.path.join(MODELS_DIR, 'shadow_log.jsonl')
+HOLDOUT_PATH = os.path.join(BASE_DIR, 'holdout')
+
+# Share the API's augmentation and ensemble logic so calibration matches serving
+sys.path.append(BASE_DIR)
+from ensemble import AUGMENTATIONS, ENSEMBLE_MAX_MODELS, augmented_views, previous_versions, temperature_key
+
+# Must match the output order of the served model (see backend.predict)
+CLASS_LABELS = ['Choroidal Neovascularization', 'Diabetic Macular Edema', 'Drusen', 'Normal']
+
+# Held-out folders follow the Kermany2018 dataset layout
+HOLDOUT_DIRS = {
+    'CNV': 'Choroidal Neovascularization',
+    'DME': 'Diabetic Macular Edema',
+    'DRUSEN': 'Drusen',
+    'NORMAL': 'Normal',
+}
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+EVAL_BATCH_SIZE = int(os.environ.get('EVAL_BATCH_SIZE', '64'))
+EVAL_WORKERS = int(os.environ.get('EVAL_WORKERS', str(os.cpu_count() or 4)))
+# Latency is timed on the first EVAL_TIMING_BATCHES batches, EVAL_TIMING_RUNS times
+EVAL_TIMING_BATCHES = int(os.environ.get('EVAL_TIMING_BATCHES', '4'))
+EVAL_TIMING_RUNS = int(os.environ.get('EVAL_TIMING_RUNS', '5'))
+# A candidate may be at most this much slower per image than production
+LATENCY_TOLERANCE = float(os.environ.get('LATENCY_TOLERANCE', '0.05'))
 
 # Initialize Celery with Redis backend
 app = Celery('oct_disease',
@@ -37,6 +71,11 @@ app.conf.beat_schedule = {
 @app.task
 def retrain_model():
     try:
+        # Without a held-out set no candidate can be evaluated, so skip training
+        holdout = load_holdout_set()
+        if holdout is None:
+            return {'status': 'no_holdout_data'}
+
         # Load the current model
         current_model = tf.keras.models.load_model(MODEL_PATH)
 
@@ -44,27 +83,65 @@ def retrain_model():
         new_data = get_new_training_data()
         
         if new_data:
-            # Retrain the model
-            history = current_model.fit(
+            # Train a separate copy so the production weights stay untouched for comparison
+            candidate_model = tf.keras.models.load_model(MODEL_PATH)
+
+            history = candidate_model.fit(
                 new_data['x_train'],
                 new_data['y_train'],
                 epochs=5,
                 validation_split=0.2
             )
             
-            # Save the retrained model
-            new_model_path = os.path.join(BASE_DIR, 'dummy_model_new.h5')
-            current_model.save(new_model_path)
+            # Save the retrained model as a new version
+            version = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+            os.makedirs(MODELS_DIR, exist_ok=True)
+            candidate_path = os.path.join(MODELS_DIR, f"model_{version}.h5")
+            candidate_model.save(candidate_path)
 
-            # If save successful, replace old model
-            os.replace(new_model_path, MODEL_PATH)
+            # Evaluate both models offline on the fixed held-out set
+            try:
+                current_metrics = evaluate_model(current_model, holdout['x'], holdout['y'])
+                candidate_metrics = evaluate_model(candidate_model, holdout['x'], holdout['y'])
+            except Exception:
+                register_version(version, candidate_path, None, promoted=False)
+                raise
+
+            promoted = should_promote(candidate_metrics, current_metrics)
+            if promoted:
+                promote_model(candidate_path)
+
+            # Report-only: covers the previous shadow candidate and is not used by should_promote
+            shadow_report = summarize_shadow_log()
+
+            # Calibrate the TTA/ensemble configurations served after this run
+            registry = load_registry()
+            production_model = candidate_model if promoted else current_model
+            production_version = version if promoted else registry.get('production')
+            try:
+                members = [production_model] + [
+                    tf.keras.models.load_model(entry['path'])
+                    for entry in previous_versions(registry, production_version, ENSEMBLE_MAX_MODELS - 1)
+                ]
+                temperatures = fit_ensemble_temperatures(members, holdout['paths'], holdout['y'])
+            except Exception as e:
+                # The promotion decision must still be recorded
+                print(f"Error fitting ensemble temperatures: {str(e)}")
+                temperatures = None
+            register_version(version, candidate_path, candidate_metrics, promoted, temperatures)
 
             return {
-                'status': 'success',
+                'status': 'promoted' if promoted else 'rejected',
+                'version': version,
                 'metrics': {
                     'accuracy': history.history['accuracy'][-1],
                     'loss': history.history['loss'][-1]
-                }
+                },
+                'evaluation': {
+                    'candidate': candidate_metrics,
+                    'current': current_metrics
+                },
+                'shadow': shadow_report
             }
         
         return {'status': 'no_new_data'}
@@ -72,6 +149,211 @@ def retrain_model():
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
+def load_image(path):
+    """Load an image from disk and preprocess it to the model input size."""
+    img = Image.open(path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img = img.resize((299, 299))
+    return img_to_array(img)
+
+def try_load_image(path):
+    try:
+        return load_image(path)
+    except Exception as e:
+        print(f"Error processing image {path}: {str(e)}")
+        return None
+
+def load_holdout_set():
+    """
+    Load the fixed held-out evaluation set from HOLDOUT_PATH.
+    Images are decoded in parallel since disk and PIL dominate load time.
+    Returns a dict with 'x', 'y' (class indices) and 'paths' or None if the set is empty
+    """
+    paths = []
+    labels = []
+    for folder, label in HOLDOUT_DIRS.items():
+        class_dir = os.path.join(HOLDOUT_PATH, folder)
+        if not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            paths.append(os.path.join(class_dir, name))
+            labels.append(CLASS_LABELS.index(label))
+
+    with ThreadPoolExecutor(max_workers=EVAL_WORKERS) as executor:
+        images = list(executor.map(try_load_image, paths))
+
+    # Skip unreadable files rather than failing the whole evaluation
+    loaded = [(img, label, path) for img, label, path in zip(images, labels, paths) if img is not None]
+    if not loaded:
+        return None
+
+    return {
+        'x': np.stack([img for img, _, _ in loaded]),
+        'y': np.array([label for _, label, _ in loaded]),
+        'paths': [path for _, _, path in loaded]
+    }
+
+def evaluate_model(model, x, y, batch_size=EVAL_BATCH_SIZE, timing_runs=EVAL_TIMING_RUNS):
+    """
+    Evaluate a model on the held-out set in fixed-size batches.
+    One full pass gives accuracy; latency is the median over `timing_runs`
+    repeats on a few fixed batches, in milliseconds per image
+    """
+    batches = [x[start:start + batch_size] for start in range(0, len(x), batch_size)]
+
+    # The full pass also traces every batch shape before timing starts
+    probabilities = np.concatenate([model.predict_on_batch(batch) for batch in batches])
+
+    timing_batches = batches[:max(EVAL_TIMING_BATCHES, 1)]
+    timed_samples = sum(len(batch) for batch in timing_batches)
+    run_latencies = []
+    for _ in range(max(timing_runs, 1)):
+        began = time.perf_counter()
+        for batch in timing_batches:
+            model.predict_on_batch(batch)
+        run_latencies.append((time.perf_counter() - began) / timed_samples * 1000)
+
+    predicted = np.argmax(probabilities, axis=1)
+    return {
+        'accuracy': float(np.mean(predicted == y)),
+        'latency_ms': float(np.median(run_latencies)),
+        'samples': int(len(x))
+    }
+
+def load_views(path):
+    """Load an image and return all of its test-time augmentation views."""
+    img = Image.open(path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return augmented_views(img, len(AUGMENTATIONS))
+
+def fit_ensemble_temperatures(members, paths, y):
+    """
+    Fit one temperature per (augmentations, models) configuration served by
+    the API's TTA/ensemble mode, on the same averaged probabilities it returns.
+    Held-out images are streamed in chunks so all views never sit in memory.
+    Returns a dict keyed by temperature_key
+    """
+    chunk_size = max(EVAL_BATCH_SIZE // len(AUGMENTATIONS), 1)
+    # Per member: list of (images, augmentations, classes) chunks
+    chunks = [[] for _ in members]
+    with ThreadPoolExecutor(max_workers=EVAL_WORKERS) as executor:
+        for start in range(0, len(paths), chunk_size):
+            views = np.stack(list(executor.map(load_views, paths[start:start + chunk_size])))
+            flat = views.reshape((-1,) + views.shape[2:])
+            for member_chunks, member in zip(chunks, members):
+                member_chunks.append(member.predict_on_batch(flat).reshape(len(views), len(AUGMENTATIONS), -1))
+
+    # Shape: (models, images, augmentations, classes)
+    probabilities = np.stack([np.concatenate(member_chunks) for member_chunks in chunks])
+
+    temperatures = {}
+    for models in range(1, len(members) + 1):
+        for augmentations in range(1, len(AUGMENTATIONS) + 1):
+            if models == 1 and augmentations == 1:
+                continue  # the default single-pass path is not scaled
+            aggregate = probabilities[:models, :, :augmentations].mean(axis=(0, 2))
+            temperatures[temperature_key(augmentations, models)] = fit_temperature(aggregate, y)
+    return temperatures
+
+def fit_temperature(probabilities, y):
+    """
+    Fit a temperature for held-out probabilities by minimizing negative
+    log-likelihood over a log-spaced grid.
+    """
+    log_probabilities = np.log(np.clip(probabilities, 1e-7, 1.0))
+    best_temperature, best_nll = 1.0, np.inf
+    for temperature in np.exp(np.linspace(np.log(0.05), np.log(10.0), 200)):
+        logits = log_probabilities / temperature
+        logits -= logits.max(axis=1, keepdims=True)
+        log_softmax = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+        nll = -np.mean(log_softmax[np.arange(len(y)), y])
+        if nll < best_nll:
+            best_temperature, best_nll = float(temperature), nll
+    return best_temperature
+
+def should_promote(candidate_metrics, current_metrics):
+    """
+    A candidate is promoted only if it is more accurate and at most
+    LATENCY_TOLERANCE slower per image than the current model.
+    """
+    if candidate_metrics['accuracy'] <= current_metrics['accuracy']:
+        return False
+    max_latency = current_metrics['latency_ms'] * (1 + LATENCY_TOLERANCE)
+    return candidate_metrics['latency_ms'] <= max_latency
+
+def promote_model(candidate_path):
+    """Atomically replace the served model with a candidate version."""
+    staged_path = os.path.join(BASE_DIR, 'dummy_model_new.h5')
+    shutil.copyfile(candidate_path, staged_path)
+    os.replace(staged_path, MODEL_PATH)
+
+def load_registry():
+    if not os.path.exists(REGISTRY_PATH):
+        return {'production': None, 'shadow': None, 'versions': []}
+    with open(REGISTRY_PATH) as f:
+        return json.load(f)
+
+def register_version(version, path, metrics, promoted, temperatures=None):
+    """
+    Record a model version in the registry.
+    Rejected candidates become the shadow model so live traffic can score them;
+    the shadow log is report-only and is not used for promotion. It is rotated
+    whenever the shadow version changes
+    """
+    registry = load_registry()
+    previous_shadow = registry.get('shadow')
+    registry['versions'].append({
+        'version': version,
+        'path': path,
+        'metrics': metrics,
+        'promoted': promoted,
+        'created_at': datetime.utcnow().isoformat()
+    })
+    if promoted:
+        registry['production'] = version
+        registry['shadow'] = None
+    else:
+        registry['shadow'] = version
+    if temperatures is not None:
+        registry['temperatures'] = temperatures
+
+    if registry['shadow'] != previous_shadow and os.path.exists(SHADOW_LOG_PATH):
+        os.replace(SHADOW_LOG_PATH, SHADOW_LOG_PATH + '.1')
+
+    staged_path = REGISTRY_PATH + '.tmp'
+    with open(staged_path, 'w') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(staged_path, REGISTRY_PATH)
+
+def summarize_shadow_log():
+    """
+    Summarize agreement between production and the current shadow version
+    on live /predict traffic.
+    """
+    shadow_version = load_registry().get('shadow')
+    if shadow_version is None or not os.path.exists(SHADOW_LOG_PATH):
+        return None
+
+    stats = {'version': shadow_version, 'requests': 0, 'agreements': 0, 'latency_ms': 0.0}
+    with open(SHADOW_LOG_PATH) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['shadow_version'] != shadow_version:
+                continue
+            stats['requests'] += 1
+            stats['agreements'] += int(record['shadow_class'] == record['production_class'])
+            stats['latency_ms'] += record['latency_ms']
+
+    if not stats['requests']:
+        return None
+    stats['agreement_rate'] = stats['agreements'] / stats['requests']
+    stats['latency_ms'] /= stats['requests']
+    return stats
+
 def get_new_training_data():
     """
     Fetch new training data from uploads folder and doctor assessments from database
@@ -106,16 +388,14 @@ def get_new_training_data():
                 image_path = scan['image_url'].replace('http://localhost:8000/uploads/', '')
                 full_path = os.path.join(UPLOADS_PATH, image_path)
 
-                # Load and preprocess image
-                img = Image.open(full_path)
-                img = img.resize((299, 299))
-                img_array = img_to_array(img)
-                img_array = np.expand_dims(img_array, axis=0)
-                
                 # Use corrected diagnosis if available, otherwise use original prediction
                 label = scan['doctor_corrected_diagnosis'] or scan['prediction_condition']
-                
-                x_train.append(img_array[0])
+                if label not in CLASS_LABELS:
+                    print(f"Skipping image {scan['image_url']}: unknown label {label}")
+                    continue
+
+                # Load and preprocess image
+                x_train.append(load_image(full_path))
                 y_train.append(label)
                 
             except Exception as e:
@@ -128,11 +408,10 @@ def get_new_training_data():
         # Convert to numpy arrays
         x_train = np.array(x_train)
         
-        # Convert labels to one-hot encoding
-        unique_labels = list(set(y_train))
-        label_to_index = {label: i for i, label in enumerate(unique_labels)}
+        # Convert labels to one-hot encoding using the model's fixed class order
+        label_to_index = {label: i for i, label in enumerate(CLASS_LABELS)}
         y_train = np.array([label_to_index[label] for label in y_train])
-        y_train = tf.keras.utils.to_categorical(y_train)
+        y_train = tf.keras.utils.to_categorical(y_train, num_classes=len(CLASS_LABELS))
         
         return {
             'x_train': x_train,
@@ -148,4 +427,4 @@ def get_new_training_data():
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
\ No newline at end of file
+            conn.close()